@@ -240,8 +240,11 @@ class Server:
 
     async def from_slack(self):
         while True:
+            # Do not even call the logging functions when they would log nothing
+            debug = logging.getLogger().isEnabledFor(logging.DEBUG)
             async for ev in self.sl_client.events():
-                logging.debug(ev)
+                if debug:
+                    logging.debug(ev)
                 await self.slack_event(ev)
 
     async def irc_command(self, line):
@@ -356,7 +359,7 @@ class Server:
         await self.sendcmd(self.client, 'MODE', self.client.nickname, self.client.modes)
 
         if self.settings.autojoin:
-            mpim_cutoff = datetime.datetime.utcnow() - MPIM_HIDE_DELAY
+            mpim_cutoff = datetime.datetime.now(datetime.timezone.utc) - MPIM_HIDE_DELAY
 
             for sl_chan in channels.values():
                 if not sl_chan.is_member:
@@ -17,23 +17,26 @@
 # author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
 
 import asyncio
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
 import datetime
-import json
+from functools import lru_cache
 import logging
-from time import time
-from typing import Literal, Optional, Any, NamedTuple, Sequence, Type, TypeVar
+import sys
+from time import monotonic, time
+from typing import AsyncIterator, Callable, Generic, Literal, Optional, Any, NamedTuple, Sequence, Type, TypeVar
 
 from typedload import dataloader, dump
-from typedload.exceptions import TypedloadValueError
+from typedload.exceptions import TypedloadException
 
 from .slackclient import SlackClient
 from .slackclient.client import LoginInfo
+from .slackclient.http import UploadFile, json_dumps, json_loads
 
 
 T = TypeVar('T')
 
-USELESS_EVENTS = frozenset((
+USELESS_EVENTS = frozenset(map(sys.intern, (
     'accounts_changed',
     'app_actions_updated',
     'apps_changed',
@@ -79,24 +82,67 @@ USELESS_EVENTS = frozenset((
     'unfurl_preview_updated',
     'update_thread_state',
     'view_updated',
-))
+)))
+
+#: Fields of the events that are interned
+INTERNED_FIELDS = ('channel', 'user', 'subtype', 'bot_id')
+
+#: How many chats to download the history of at the same time
+HISTORY_WORKERS = 8
+
+#: How many IMs to keep in the cache
+IMCACHE_SIZE = 4096
+
+_UTC = datetime.timezone.utc
 
 
 class ResponseException(Exception):
     pass
 
 
-class Response(NamedTuple):
+class BoundedSet(Generic[T]):
     """
-    Internally used to parse a response from the API.
+    A set that remembers the order in which items were added.
+
+    The oldest items are dropped when there are more than maxlen,
+    or with expire().
     """
-    ok: bool
-    headers: dict[str, str]
-    ts: Optional[float] = None
-    error: Optional[str] = None
+    def __init__(self, maxlen: int) -> None:
+        self.maxlen = maxlen
+        self._items: set[T] = set()
+        # (time added, item)
+        # Discarded items are left here, and skipped when they are dropped
+        self._order: deque[tuple[float, T]] = deque()
 
+    def __contains__(self, item: T) -> bool:
+        return item in self._items
 
-@dataclass
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, item: T) -> None:
+        self._items.add(item)
+        self._order.append((monotonic(), item))
+        if len(self._order) > self.maxlen:
+            self._items.discard(self._order.popleft()[1])
+
+    def discard(self, item: T) -> None:
+        self._items.discard(item)
+
+    def expire(self, max_age: float) -> None:
+        """
+        Drop the items that were added more than max_age seconds ago.
+
+        This uses a monotonic clock, so changes to the system
+        time do not matter.
+        """
+        order = self._order
+        limit = monotonic() - max_age
+        while order and order[0][0] <= limit:
+            self._items.discard(order.popleft()[1])
+
+
+@dataclass(slots=True)
 class File:
     id: str
     url_private: str
@@ -119,10 +165,33 @@ class LatestMessage(NamedTuple):
 
     @property
     def timestamp(self):
-        return datetime.datetime.utcfromtimestamp(self.ts)
+        return datetime.datetime.fromtimestamp(self.ts, tz=_UTC)
+
+
+@lru_cache(maxsize=None)
+def _channel_modes(is_private: bool, is_group: bool, is_mpim: bool) -> str:
+    modes = '+'
+    if is_private:
+        modes += 'p'
+    if is_group:
+        modes += 'g'
+    if is_mpim:
+        modes += 'i'
+
+    return modes
+
 
+@lru_cache(maxsize=None)
+def _user_modes(is_admin: bool, is_owner: bool) -> str:
+    modes = '+'
+    if is_admin:
+        modes += 'a'
+    if is_owner:
+        modes += 'o'
+    return modes
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class Channel:
     """
     A channel description.
@@ -155,15 +224,7 @@ class Channel:
 
     @property
     def irc_modes(self):
-        modes = '+'
-        if self.is_private:
-            modes += 'p'
-        if self.is_group:
-            modes += 'g'
-        if self.is_mpim:
-            modes += 'i'
-
-        return modes
+        return _channel_modes(self.is_private, self.is_group, self.is_mpim)
 
     @property
     def real_topic(self) -> str:
@@ -175,12 +236,12 @@ class Channel:
             return ''
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class MessageThread(Channel):
     thread_ts: str = ''
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Message:
     channel: str  # The channel id
     user: str  # The user id
@@ -195,7 +256,7 @@ class Message:
         return self.subtype == 'me_message'
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class IgnoredMessage:
     """
     We don't care about this message, but as the type is 'message', we need to
@@ -213,20 +274,20 @@ class NoChanMessage(NamedTuple):
     username: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ChannelCreated:
     type: Literal['channel_created']
     channel: Channel
 
 
-@dataclass
+@dataclass(slots=True)
 class ChannelDeleted:
     type: Literal['channel_deleted']
     channel_id: str = field(metadata={'name': 'channel'})
     actor_id: str
 
 
-@dataclass
+@dataclass(slots=True)
 class GroupJoined:
     type: Literal['group_joined']
     channel: Channel
@@ -236,7 +297,7 @@ class GroupJoined:
         return self.channel.id
 
 
-@dataclass
+@dataclass(slots=True)
 class ChannelJoined:
     type: Literal['channel_joined']
     channel: Channel
@@ -246,7 +307,7 @@ class ChannelJoined:
         return self.channel.id
 
 
-@dataclass
+@dataclass(slots=True)
 class GroupRename:
     type: Literal['group_rename']
     channel: Channel
@@ -256,7 +317,7 @@ class GroupRename:
         return self.channel.id
 
 
-@dataclass
+@dataclass(slots=True)
 class ChannelRename:
     type: Literal['channel_rename']
     channel: Channel
@@ -266,21 +327,21 @@ class ChannelRename:
         return self.channel.id
 
 
-@dataclass
+@dataclass(slots=True)
 class MPIMJoined:
     type: Literal['mpim_open']
     channel_id: str = field(metadata={'name': 'channel'})
     channel: Channel = None
 
 
-@dataclass
+@dataclass(slots=True)
 class GroupLeft:
     type: Literal['group_left']
     channel_id: str = field(metadata={'name': 'channel'})
     actor_id: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ChannelLeft:
     # https://api.slack.com/events/channel_left
     # "The channel_left event is sometimes sent to all connections for a user
@@ -291,14 +352,14 @@ class ChannelLeft:
     actor_id: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MPIMLeft:
     type: Literal['mpim_close']
     channel_id: str = field(metadata={'name': 'channel'})
     actor_id: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageEdit:
     type: Literal['message']
     subtype: Literal['message_changed']
@@ -312,7 +373,7 @@ class MessageEdit:
         return self.previous.text != self.current.text
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageDelete:
     type: Literal['message']
     subtype: Literal['message_deleted']
@@ -338,7 +399,7 @@ class Profile(NamedTuple):
     phone: str = ''
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageBot:
     type: Literal['message']
     _text: str = field(metadata={'name': 'text'})
@@ -364,22 +425,17 @@ class MessageBot:
     @property
     def text(self):
         r = [self._text]
+        extend = r.extend
         for block in self.blocks:
-            if 'text' in block:
-                for line in block['text']['text'].split('\n'):
-                    r.append(f"| {line}")
-            for element in block.get('elements', ()):
+            get = block.get
+            if (text := get('text')) is not None:
+                extend('| ' + line for line in text['text'].splitlines() or ('',))
+            for element in get('elements', ()):
                 if element['type'] == 'text':
-                    for line in element['text'].split('\n'):
-                        r.append(f"| {line}")
+                    extend('| ' + line for line in element['text'].splitlines() or ('',))
         for i in self.attachments:
-            t = ""
-            if 'text' in i:
-                t = i['text']
-            elif 'fallback' in i:
-                t = i['fallback']
-            for line in t.split("\n"):
-                r.append("| " + line)
+            t = i.get('text') or i.get('fallback') or ''
+            extend('| ' + line for line in t.splitlines() or ('',))
         return '\n'.join(r)
 
 
@@ -401,15 +457,9 @@ class User(NamedTuple):
 
     @property
     def irc_modes(self) -> str:
-        modes = '+'
-        if self.is_admin:
-            modes += 'a'
-        if self.is_owner:
-            modes += 'o'
-        return modes
+        return _user_modes(self.is_admin, self.is_owner)
 
 
-@dataclass
 class UserChange(NamedTuple):
     type: Literal['user_change']
     user: User
@@ -436,7 +486,7 @@ class Leave(NamedTuple):
     channel: str
 
 
-@dataclass
+@dataclass(slots=True)
 class TopicChange:
     type: Literal['message']
     subtype: Literal['channel_topic']
@@ -445,7 +495,7 @@ class TopicChange:
     user: str
 
 
-@dataclass
+@dataclass(slots=True)
 class HistoryBotMessage:
     type: Literal['message']
     subtype: Literal['bot_message']
@@ -458,8 +508,24 @@ class HistoryBotMessage:
     blocks: list[dict[str, Any]] = field(default_factory=list)
     attachments: list[dict[str, Any]] = field(default_factory=list)
 
+    def to_event(self, channel: str) -> MessageBot:
+        """
+        The event to inject for this message when replaying history.
+        """
+        return MessageBot(
+            type='message',
+            subtype='bot_message',
+            _text=self.text,
+            attachments=self.attachments,
+            blocks=self.blocks,
+            _username=self.username,
+            channel=channel,
+            bot_id=self.bot_id,
+            thread_ts=self.thread_ts,
+        )
+
 
-@dataclass
+@dataclass(slots=True)
 class HistoryMessage:
     type: Literal['message']
     user: str
@@ -468,6 +534,18 @@ class HistoryMessage:
     files: list[File] = field(default_factory=list)
     thread_ts: Optional[str] = None
 
+    def to_event(self, channel: str) -> Message:
+        """
+        The event to inject for this message when replaying history.
+        """
+        return Message(
+            channel=channel,
+            text=self.text,
+            user=self.user,
+            thread_ts=self.thread_ts,
+            files=self.files,
+        )
+
 
 class NextCursor(NamedTuple):
     next_cursor: str
@@ -512,8 +590,37 @@ SlackEvent = (
     UserChange
 )
 
-
-@dataclass
+#: Type to load an event as, by (type, subtype).
+#: Events not listed here are loaded as a SlackEvent.
+EVENT_DISPATCH: dict[tuple[str, Optional[str]], Any] = {
+    ('message', None): Message,
+    ('message', 'me_message'): Message,
+    ('message', 'file_share'): Message,
+    ('message', 'thread_broadcast'): Message,
+    ('message', 'channel_topic'): TopicChange,
+    ('message', 'message_replied'): IgnoredMessage,
+    ('message', 'channel_name'): IgnoredMessage,
+    ('message', 'message_deleted'): MessageDelete,
+    ('message', 'message_changed'): MessageEdit,
+    ('message', 'bot_message'): MessageBot,
+    ('member_joined_channel', None): Join,
+    ('member_left_channel', None): Leave,
+    ('channel_created', None): ChannelCreated,
+    ('channel_deleted', None): ChannelDeleted,
+    ('group_joined', None): GroupJoined,
+    ('channel_joined', None): ChannelJoined,
+    ('mpim_open', None): MPIMJoined,
+    ('group_rename', None): GroupRename,
+    ('channel_rename', None): ChannelRename,
+    ('group_left', None): GroupLeft,
+    ('channel_left', None): ChannelLeft,
+    ('mpim_close', None): MPIMLeft,
+    ('user_typing', None): UserTyping,
+    ('user_change', None): UserChange,
+}
+
+
+@dataclass(slots=True)
 class SlackStatus:
     """
     Not related to the slack API.
@@ -523,6 +630,14 @@ class SlackStatus:
     last_timestamp: float = 0.0
 
 
+def _id(obj: Channel | IM | User | str) -> str:
+    '''
+    Returns the slack id of an object, or the object itself
+    if it is already an id.
+    '''
+    return obj if type(obj) is str else obj.id  # type: ignore
+
+
 class Slack:
     def __init__(self, token: str, cookie: Optional[str], previous_status: Optional[str]) -> None:
         """
@@ -536,29 +651,47 @@ class Slack:
         self.client = SlackClient(token, cookie)
         self._usercache: dict[str, User] = {}
         self._usermapcache: dict[str, User] = {}
-        self._usermapcache_keys: list[str]
-        self._imcache: dict[str, str] = {}
+        self._users_prefetched_at: Optional[float] = None  # monotonic() when prefetch_users last completed
+        self._n_regular = self._n_bots = self._n_admins = 0  # Counters of the users in _usercache
+        self._imcache: OrderedDict[str, str] = OrderedDict()  # user id -> IM id, LRU
+        self._imcache_reverse: dict[str, str] = {}  # IM id -> user id
         self._channelscache: dict[str, Channel] = {}
+        self._channels_by_name: dict[str, Channel] = {}
         self._get_members_cache: dict[str, set[str]] = {}
         self._get_members_cache_cursor: dict[str, Optional[str]] = {}
-        self._internalevents: list[SlackEvent] = []
-        self._sent_by_self: set[float] = set()
+        self._internalevents: deque[SlackEvent] = deque()
+        self._sent_by_self: BoundedSet[tuple[str, str]] = BoundedSet(4096)  # (channel, ts) of the messages sent
         self._wsblock: int = 0  # Semaphore to block the socket and avoid events being received before their API call ended.
+        self._wsunblocked = asyncio.Event()  # Set when _wsblock is 0
+        self._wsunblocked.set()
+        self._mark_queue: asyncio.Queue[tuple[str, str]] = asyncio.Queue()  # Channels to mark as read
+        self._mark_task: Optional[asyncio.Task] = None
         self.login_info: Optional[LoginInfo] = None
-        self.loader = dataloader.Loader()
+        # Functions to update the caches when some events are received
+        self._event_handlers: dict[type, Callable[[Any], None]] = {
+            Join: self._on_join,
+            Leave: self._on_leave,
+            UserChange: self._on_user_change,
+        }
+        # A single loader is shared, because it caches the handler of every type it loads.
+        # Slack sends many fields that are not used here, and sends timestamps
+        # as strings, so extra fields must be ignored and basic types cast.
+        self.loader = dataloader.Loader(failonextra=False, basiccast=True)
 
         if previous_status is None:
             self._status = SlackStatus()
         else:
-            self._status = self.tload(json.loads(previous_status), SlackStatus)
+            self._status = self.tload(json_loads(previous_status), SlackStatus)
 
     def close(self):
+        if self._mark_task is not None:
+            self._mark_task.cancel()
         self.client.close()
 
     def tload(self, data: Any, type_: Type[T]) -> T:
         try:
             return self.loader.load(data, type_)
-        except TypedloadValueError:
+        except TypedloadException:
             logging.error('Unable to parse', exc_info=True)
             logging.error(data)
             raise
@@ -570,6 +703,25 @@ class Slack:
         logging.info('Login in slack')
         self.login_info = await self.client.login(15)
 
+    async def _paginate(self, api: str, **kwargs) -> AsyncIterator[dict[str, Any]]:
+        """
+        Calls an API that uses cursors, yielding the reply of every page.
+
+        Stops when there are no more pages, or when slack sends the
+        same cursor again.
+        """
+        cursor = None
+        while True:
+            r = await self.client.api_call(api, cursor=cursor, **kwargs)
+            yield r
+            if r.get('has_more') is False:
+                break
+            # Some APIs send an empty string as next cursor, just to show off their programming "skillz"
+            next_cursor = (r.get('response_metadata') or {}).get('next_cursor')
+            if not next_cursor or next_cursor == cursor:
+                break
+            cursor = next_cursor
+
     async def get_history(
         self,
         channel: Channel | IM | str,
@@ -580,51 +732,94 @@ class Slack:
     ) -> History:
         p = await self.client.api_call(
             'conversations.history',
-            channel=channel if isinstance(channel, str) else channel.id,
+            channel=_id(channel),
             oldest=ts,
             limit=limit,
             cursor=cursor.next_cursor if cursor else None,
             inclusive=inclusive,
         )
-        return self.tload(p, History)
+        return self._load_history(p)
+
+    def _count_user(self, user: User, delta: int) -> None:
+        """
+        Update the user counters when a user enters (delta=1)
+        or leaves (delta=-1) the user cache.
+        """
+        if user.is_bot:
+            self._n_bots += delta
+        else:
+            self._n_regular += delta
+        if user.is_admin:
+            self._n_admins += delta
+
+    def _insert_user(self, user: User) -> None:
+        """
+        Add a user to the user caches, replacing the previous
+        version of the same user, if any.
+        """
+        old = self._usercache.get(user.id)
+        if old is not None:
+            self._count_user(old, -1)
+            # The user was renamed, drop the old name
+            if old.name != user.name and self._usermapcache.get(old.name) is old:
+                del self._usermapcache[old.name]
+        self._usercache[sys.intern(user.id)] = user
+        self._usermapcache[sys.intern(user.name)] = user
+        self._count_user(user, 1)
+
+    def _load_history(self, data: Any) -> History:
+        """
+        Load a History.
+
+        Messages are loaded according to their subtype rather than as
+        a union: both message types share the same Literal type field,
+        so typedload would try HistoryBotMessage first on every message.
+        """
+        messages = data.get('messages')
+        if not isinstance(messages, list):
+            # Let typedload report the problem
+            return self.tload(data, History)
+        history = self.tload(data | {'messages': []}, History)
+        return history._replace(messages=[self._load_history_message(i) for i in messages])
+
+    def _load_history_message(self, data: Any) -> HistoryMessage | HistoryBotMessage:
+        """
+        Load a message of the history, trying the class matching its
+        subtype first, and then the union, like typedload would.
+        """
+        if isinstance(data, dict) and data.get('subtype') == 'bot_message':
+            type_: Type[HistoryMessage | HistoryBotMessage] = HistoryBotMessage
+        else:
+            type_ = HistoryMessage
+        try:
+            return self.loader.load(data, type_)
+        except TypedloadException:
+            return self.tload(data, HistoryMessage | HistoryBotMessage)  # type: ignore
 
     async def count_regular_users(self):
-        return len([u for u in self._usercache.values() if not u.is_bot])
+        return self._n_regular
 
     async def count_bots(self):
-        return len([u for u in self._usercache.values() if u.is_bot])
+        return self._n_bots
 
     async def count_admins(self):
-        return len([u for u in self._usercache.values() if u.is_admin])
+        return self._n_admins
 
     async def get_thread_history(self, channel: str, thread_id: str) -> list[HistoryMessage | HistoryBotMessage]:
         r: list[HistoryMessage | HistoryBotMessage] = []
-        cursor = None
         logging.info('Thread history %s %s', channel, thread_id)
-        while True:
+        async for p in self._paginate('conversations.replies', channel=channel, ts=thread_id, limit=1000):
             logging.info('Cursor')
-            p = await self.client.api_call(
-                'conversations.replies',
-                channel=channel,
-                ts=thread_id,
-                limit=1000,
-                cursor=cursor,
-            )
-            response = self.tload(p, Response)
-            if not response.ok:
-                logging.debug(f'Unable to find thread {thread_id}: {response.error}')
+            if not p.get('ok'):
+                logging.debug('Unable to find thread %s: %s', thread_id, p.get('error'))
                 return []
 
             try:
-                response = self.tload(p, History)
-            except TypedloadValueError:
+                history = self._load_history(p)
+            except TypedloadException:
                 break
 
-            r += [i for i in response.messages if i.ts != i.thread_ts]
-            if response.has_more and response.response_metadata:
-                cursor = response.response_metadata.next_cursor
-            else:
-                break
+            r += [i for i in history.messages if i.ts != i.thread_ts]
         logging.info('Thread fetched')
         if len(r) > 0:
             # if not, maybe a thread with all messages deleted, handle it anyway.
@@ -652,86 +847,86 @@ class Slack:
 
         chats: Sequence[IM | Channel] = []
         chats += list((await self.channels()).values()) + await self.get_ims()  # type: ignore
-        for channel in chats:
-            if isinstance(channel, Channel):
-                if not channel.is_member:
-                    continue
 
-                logging.info('Downloading logs from channel %s', channel.name_normalized)
-            else:
-                logging.info('Downloading logs from IM %s', channel.user)
-
-            cursor = None
-            while True:  # Loop to iterate the cursor
-                logging.info('Calling cursor')
-                try:
-                    response = await self.get_history(channel, str(last_timestamp))
-                except TypedloadValueError:
-                    break
-                msg_list = list(response.messages)
-                while msg_list:
-                    msg = msg_list.pop(0)
-
-                    # The last seen message is sent again, skip it
-                    if msg.ts == last_timestamp:
-                        continue
-                    # Update the last seen timestamp
-                    if self._status.last_timestamp < msg.ts:
-                        self._status.last_timestamp = msg.ts
-
-                    # History for the thread
-                    if msg.thread_ts and float(msg.thread_ts) == msg.ts:
-                        history = await self.get_thread_history(channel.id, msg.thread_ts)
-                        history.reverse()
-                        msg_list = history + msg_list
+        # Download several chats at once.
+        # The HTTP connections are cached per task, so rather than a task
+        # per chat, a few workers share the chats to download.
+        pending = iter(chats)
+
+        async def worker() -> None:
+            try:
+                for channel in pending:
+                    # A chat failing must not prevent getting the others
+                    try:
+                        events = await self._chat_history(channel, last_timestamp)
+                    except Exception as e:
+                        logging.error('Unable to fetch history of %s: %s', channel.id, e)
                         continue
+                    self._internalevents.extend(events)
+            finally:
+                self.client.close_connection()
 
-                    # Inject the events
-                    if isinstance(msg, HistoryMessage):
-                        self._internalevents.append(Message(
-                            channel=channel.id,
-                            text=msg.text,
-                            user=msg.user,
-                            thread_ts=msg.thread_ts,
-                            files=msg.files,
-                        ))
-                    elif isinstance(msg, HistoryBotMessage):
-                        self._internalevents.append(MessageBot(
-                            type='message',
-                            subtype='bot_message',
-                            _text=msg.text,
-                            attachments=msg.attachments,
-                            blocks=msg.blocks,
-                            _username=msg.username,
-                            channel=channel.id,
-                            bot_id=msg.bot_id,
-                            thread_ts=msg.thread_ts,
-                        ))
-
-                if response.has_more and response.response_metadata:
-                    next_cursor = response.response_metadata.next_cursor
-                    if next_cursor == cursor:
-                        break
-                    cursor = next_cursor
-                else:
-                    break
+        await asyncio.gather(*(worker() for _ in range(HISTORY_WORKERS)))
+
+    async def _chat_history(self, channel: IM | Channel, last_timestamp: float) -> list[SlackEvent]:
+        '''
+        Returns the messages of a chat since last_timestamp as events,
+        oldest first.
+        '''
+        if isinstance(channel, Channel):
+            if not channel.is_member:
+                return []
+
+            logging.info('Downloading logs from channel %s', channel.name_normalized)
+        else:
+            logging.info('Downloading logs from IM %s', channel.user)
+
+        # Slack sends the newest messages first
+        channel_events: list[SlackEvent] = []
+        async for p in self._paginate(
+            'conversations.history',
+            channel=channel.id,
+            oldest=str(last_timestamp),
+            limit=1000,
+            inclusive=False,
+        ):
+            logging.info('Calling cursor')
+            try:
+                response = self._load_history(p)
+            except TypedloadException:
+                break
+            msg_list = deque(response.messages)
+            while msg_list:
+                msg = msg_list.popleft()
+
+                # The last seen message is sent again, skip it
+                if msg.ts == last_timestamp:
+                    continue
+                # Update the last seen timestamp
+                if self._status.last_timestamp < msg.ts:
+                    self._status.last_timestamp = msg.ts
+
+                # History for the thread
+                if msg.thread_ts and float(msg.thread_ts) == msg.ts:
+                    history = await self.get_thread_history(channel.id, msg.thread_ts)
+                    msg_list.extendleft(history)
+                    continue
+
+                # Inject the events
+                channel_events.append(msg.to_event(channel.id))
+        channel_events.reverse()
+        return channel_events
 
     def get_status(self) -> str:
         '''
         A status string that will be passed back when this is started again
         '''
-        return json.dumps(dump(self._status), ensure_ascii=True)
+        return json_dumps(dump(self._status))
 
     async def is_user_away(self, user: User | str) -> bool:
-        if isinstance(user, User):
-            user_id = user.id
-        else:
-            user_id = user
-
-        r = await self.client.api_call('users.getPresence', user=user_id)
-        response = self.tload(r, Response)
-        if not response.ok:
-            raise ResponseException(response.error)
+        r = await self.client.api_call('users.getPresence', user=_id(user))
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
 
         presence = self.tload(r, Presence)
         return presence.presence == 'away'
@@ -742,37 +937,29 @@ class Slack:
         """
         status = 'away' if is_away else 'auto'
         r = await self.client.api_call('users.setPresence', presence=status)
-        response = self.tload(r, Response)
-        if not response.ok:
-            raise ResponseException(response.error)
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
 
     async def typing(self, channel: Channel | str) -> None:
         """
         Sends a typing event to slack
         """
-        if isinstance(channel, Channel):
-            ch_id = channel.id
-        else:
-            ch_id = channel
-        await self.client.wspacket(type='typing', channel=ch_id)
+        await self.client.wspacket(type='typing', channel=_id(channel))
 
     async def topic(self, channel: Channel, topic: str) -> None:
         r = await self.client.api_call('conversations.setTopic', channel=channel.id, topic=topic)
-        response: Response = self.tload(r, Response)
-        if not response.ok:
-            raise ResponseException(response.error)
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
 
     async def kick(self, channel: Channel, user: User) -> None:
         r = await self.client.api_call('conversations.kick', channel=channel.id, user=user.id)
-        response = self.tload(r, Response)
-        if not response.ok:
-            raise ResponseException(response.error)
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
 
     async def join(self, channel: Channel) -> None:
         r = await self.client.api_call('conversations.join', channel=channel.id)
-        response = self.tload(r, Response)
-        if not response.ok:
-            raise ResponseException(response.error)
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
 
     async def invite(self, channel: Channel, user: User | list[User]) -> None:
         if isinstance(user, User):
@@ -783,9 +970,8 @@ class Slack:
             ids = ','.join(i.id for i in user)
 
         r = await self.client.api_call('conversations.invite', channel=channel.id, users=ids)
-        response = self.tload(r, Response)
-        if not response.ok:
-            raise ResponseException(response.error)
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
 
     async def get_members(self, channel: str | Channel, refresh: bool = None) -> set[str]:
         """
@@ -800,11 +986,7 @@ class Slack:
         If refresh is True, force the cache to be updated
         If refresh is False, the cache is never updated
         """
-        if isinstance(channel, Channel):
-            id_ = channel.id
-        else:
-            id_ = channel
-
+        id_ = _id(channel)
         cached = self._get_members_cache.get(id_, set())
         cursor = self._get_members_cache_cursor.get(id_)
         if (cursor == '' and refresh is not None) or refresh is False:
@@ -814,18 +996,18 @@ class Slack:
         if cursor:
             kwargs['cursor'] = cursor
         r = await self.client.api_call('conversations.members', channel=id_, limit=5000, **kwargs)  # type: ignore
-        response = self.tload(r, Response)
-        if not response.ok:
-            raise ResponseException(response.error)
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
 
         newusers = self.tload(r['members'], set[str])
 
-        # Generate all the Join events, if this is not the 1st iteration
         if id_ in self._get_members_cache:
+            # Generate all the Join events, if this is not the 1st iteration
             for i in newusers.difference(cached):
                 self._internalevents.append(Join('member_joined_channel', user=i, channel=id_))
-
-        self._get_members_cache[id_] = cached.union(newusers)
+            cached.update(newusers)
+        else:
+            self._get_members_cache[id_] = newusers
         self._get_members_cache_cursor[id_] = r.get('response_metadata', {}).get('next_cursor')
         return self._get_members_cache[id_]
 
@@ -838,31 +1020,22 @@ class Slack:
         """
         if refresh is True:
             self._channelscache.clear()
+            self._channels_by_name.clear()
 
         if self._channelscache or refresh is False:
             return self._channelscache
 
-        cursor = None
-        while True:
-            r = await self.client.api_call(
-                'conversations.list',
-                cursor=cursor,
-                exclude_archived=True,
-                types='public_channel,private_channel,mpim',
-                limit=1000,  # In vain hope that slack would not ignore this
-            )
-            response = self.tload(r, Response)
-
-            if response.ok:
-                conv = self.tload(r, Conversations)
-                for chan in conv.channels:
-                    self._channelscache[chan.id] = chan
-                # For this API, slack sends an empty string as next cursor, just to show off their programming "skillz"
-                if not conv.response_metadata or not conv.response_metadata.next_cursor:
-                    break
-                cursor = conv.response_metadata.next_cursor
-            else:
-                raise ResponseException(response.error)
+        async for r in self._paginate(
+            'conversations.list',
+            exclude_archived=True,
+            types='public_channel,private_channel,mpim',
+            limit=1000,  # In vain hope that slack would not ignore this
+        ):
+            if not r.get('ok'):
+                raise ResponseException(r.get('error'))
+            for chan in self.tload(r, Conversations).channels:
+                self._channelscache[sys.intern(chan.id)] = chan
+                self._channels_by_name.setdefault(chan.name, chan)
         return self._channelscache
 
     async def get_channel(self, id_: str, refresh: bool = False) -> Channel:
@@ -883,9 +1056,9 @@ class Slack:
         raises KeyError if it doesn't exist.
         """
         for i in range(2):
-            for c in (await self.channels(refresh=bool(i))).values():
-                if c.name == name:
-                    return c
+            await self.channels(refresh=bool(i))
+            if name in self._channels_by_name:
+                return self._channels_by_name[name]
         raise KeyError()
 
     async def get_thread(self, thread_ts: str, original_channel: str, source: str) -> MessageThread:
@@ -927,16 +1100,34 @@ class Slack:
     async def get_im(self, im_id: str) -> Optional[IM]:
         if not im_id.startswith('D'):
             return None
-        for uid, imid in self._imcache.items():
-            if im_id == imid:
-                return IM(user=uid, id=imid)
-
-        for im in await self.get_ims():
-            self._imcache[im.user] = im.id
-            if im.id == im_id:
-                return im
+        uid = self._imcache_reverse.get(im_id)
+        if uid is not None:
+            self._imcache.move_to_end(uid)
+            return IM(user=uid, id=im_id)
+
+        await self.get_ims()
+        uid = self._imcache_reverse.get(im_id)
+        if uid is not None:
+            return IM(user=uid, id=im_id)
         return None
 
+    def _imcache_get(self, user_id: str) -> Optional[str]:
+        im_id = self._imcache.get(user_id)
+        if im_id is not None:
+            self._imcache.move_to_end(user_id)
+        return im_id
+
+    def _imcache_put(self, user_id: str, im_id: str) -> None:
+        old = self._imcache.get(user_id)
+        if old is not None and old != im_id:
+            del self._imcache_reverse[old]
+        self._imcache[user_id] = im_id
+        self._imcache.move_to_end(user_id)
+        self._imcache_reverse[im_id] = user_id
+        if len(self._imcache) > IMCACHE_SIZE:
+            _, old = self._imcache.popitem(last=False)
+            del self._imcache_reverse[old]
+
     async def get_ims(self) -> list[IM]:
         """
         Returns a list of the IMs
@@ -950,13 +1141,24 @@ class Slack:
             exclude_archived=True,
             types='im', limit=1000
         )
-        response = self.tload(r, Response)
-        if response.ok:
-            return self.tload(r['channels'], list[IM])
-        raise ResponseException(response.error)
+        if not r.get('ok'):
+            raise ResponseException(r.get('error'))
+        ims = self.tload(r['channels'], list[IM])
+        for im in ims:
+            self._imcache_put(im.user, im.id)
+        return ims
 
     async def get_user_by_name(self, name: str) -> User:
-        if name not in self._usermapcache:
+        """
+        Returns a user object from a slack user name
+
+        raises KeyError if it does not exist
+
+        If the name is not known, the list of users is downloaded
+        again, but at most once a minute.
+        """
+        prefetched_at = self._users_prefetched_at
+        if name not in self._usermapcache and (prefetched_at is None or monotonic() - prefetched_at > 60):
             await self.prefetch_users()
 
         return self._usermapcache[name]
@@ -966,12 +1168,10 @@ class Slack:
         Prefetch all team members for the slack team.
         """
         r = await self.client.api_call("users.list")
-        response = self.tload(r, Response)
-        if response.ok:
+        if r.get('ok'):
             for user in self.tload(r['members'], list[User]):
-                self._usercache[user.id] = user
-                self._usermapcache[user.name] = user
-            self._usermapcache_keys = []
+                self._insert_user(user)
+            self._users_prefetched_at = monotonic()
 
     async def get_user(self, id_: str) -> User:
         """
@@ -983,49 +1183,63 @@ class Slack:
             return self._usercache[id_]
 
         r = await self.client.api_call("users.info", user=id_)
-        response = self.tload(r, Response)
-        if response.ok:
+        if r.get('ok'):
             u = self.tload(r['user'], User)
-            self._usercache[id_] = u
-            if u.name not in self._usermapcache:
-                self._usermapcache_keys = []
-            self._usermapcache[u.name] = u
+            self._insert_user(u)
             return u
 
-        raise KeyError(response)
+        raise KeyError(r.get('error'))
 
     async def send_file(self, channel_id: str, filename: str, thread_ts: Optional[str]) -> None:
         """
         Send a file to a channel or group or whatever
         """
         with open(filename, 'rb') as f:
-            r = await self.client.api_call(
-                'files.upload',
-                channels=channel_id,
-                thread_ts=thread_ts,
-                file=f,
-            )
-        response = self.tload(r, Response)
-        if response.ok:
+            # Read in a thread, not to block the event loop on big files
+            data = await asyncio.to_thread(f.read)
+        r = await self.client.api_call(
+            'files.upload',
+            channels=channel_id,
+            thread_ts=thread_ts,
+            file=UploadFile(filename, data),
+        )
+        if r.get('ok'):
             return
-        raise ResponseException(response.error)
+        raise ResponseException(r.get('error'))
 
     def _triage_sent_by_self(self) -> None:
         """
         Clear all the old leftovers in
         _sent_by_self
         """
-        r = []
-        for i in self._sent_by_self:
-            if time() - i >= 10:
-                r.append(i)
-        for i in r:
-            self._sent_by_self.remove(i)
+        self._sent_by_self.expire(10)
 
     async def send_message(self, channel: Channel | MessageThread, msg: str, action: bool) -> None:
         thread_ts = channel.thread_ts if isinstance(channel, MessageThread) else None
         return await self._send_message(channel.id, msg, action, thread_ts)
 
+    def _mark_read(self, channel_id: str, ts: str) -> None:
+        """
+        Queue marking a channel as read up to ts.
+
+        A single task does all the marking, so it keeps reusing
+        the same HTTP connection.
+        """
+        if self._mark_task is None:
+            self._mark_task = asyncio.create_task(self._mark_worker())
+        self._mark_queue.put_nowait((channel_id, ts))
+
+    async def _mark_worker(self) -> None:
+        while True:
+            channel_id, ts = await self._mark_queue.get()
+            try:
+                r = await self.client.api_call('conversations.mark', channel=channel_id, ts=ts)
+            except Exception as e:
+                logging.error('Unable to mark %s as read: %s', channel_id, e)
+                continue
+            if not r.get('ok'):
+                logging.error('Unable to mark %s as read: %s', channel_id, r.get('error'))
+
     async def _send_message(self, channel_id: str, msg: str, action: bool, thread_ts: Optional[str]) -> None:
         """
         Send a message to a channel or group or whatever
@@ -1042,6 +1256,7 @@ class Slack:
                 kwargs['thread_ts'] = thread_ts
 
             self._wsblock += 1
+            self._wsunblocked.clear()
             r = await self.client.api_call(
                 api,
                 channel=channel_id,
@@ -1049,20 +1264,18 @@ class Slack:
                 as_user=True,
                 **kwargs,  # type: ignore
             )
-            response = self.tload(r, Response)
-            if response.ok and response.ts:
-                # Mark this channel as read
-                await self.client.api_call(
-                    'conversations.mark',
-                    channel=channel_id,
-                    ts=response.ts
-                )
+            if r.get('ok') and r.get('ts'):
+                # Mark this channel as read, without waiting for it
+                self._mark_read(channel_id, r['ts'])
 
-                self._sent_by_self.add(response.ts)
+                # ts is only unique within a channel
+                self._sent_by_self.add((r.get('channel', channel_id), r['ts']))
                 return
-            raise ResponseException(response.error)
+            raise ResponseException(r.get('error'))
         finally:
             self._wsblock -= 1
+            if not self._wsblock:
+                self._wsunblocked.set()
 
     async def send_message_to_user(self, user: User, msg: str, action: bool):
         """
@@ -1073,31 +1286,22 @@ class Slack:
         # so to deliver a message to them, a channel id is required.
         # Those are called IM.
 
-        if user.id in self._imcache:
-            # channel id is cached
-            channel_id = self._imcache[user.id]
-        else:
-            # Find the channel id
-            found = False
-            # Iterate over all the existing conversations
-            for i in await self.get_ims():
-                if i.user == user.id:
-                    channel_id = i.id
-                    found = True
-                    break
+        channel_id = self._imcache_get(user.id)
+        if channel_id is None:
+            # Refresh the existing conversations
+            await self.get_ims()
+            channel_id = self._imcache_get(user.id)
             # A conversation does not exist, create one
-            if not found:
+            if channel_id is None:
                 r = await self.client.api_call(
                     "im.open",
                     return_im=True,
                     user=user.id,
                 )
-                response = self.tload(r, Response)
-                if not response.ok:
-                    raise ResponseException(response.error)
+                if not r.get('ok'):
+                    raise ResponseException(r.get('error'))
                 channel_id = r['channel']['id']
-
-            self._imcache[user.id] = channel_id
+                self._imcache_put(user.id, channel_id)
 
         await self._send_message(channel_id, msg, action, None)
 
@@ -1106,61 +1310,118 @@ class Slack:
         This returns the events from the slack websocket
         """
         if self._internalevents:
-            yield self._internalevents.pop()
+            while self._internalevents:
+                yield self._internalevents.popleft()
             return
 
         try:
             events = await self.client.rtm_read()
         except Exception:
-            events = []
             logging.info('Connecting to slack...')
             self.login_info = await self.client.rtm_connect(5)
             await self._history()
             logging.info('Connected to slack')
+            # Give out the history right away
+            while self._internalevents:
+                yield self._internalevents.popleft()
             return
 
-        while self._wsblock:  # Retry until the semaphore is free
-            await asyncio.sleep(0.01)
+        # Events queued while waiting on the websocket go first,
+        # but the batch that was read must not be lost
+        while self._internalevents:
+            yield self._internalevents.popleft()
+
+        while self._wsblock:  # Wait until the semaphore is free
+            await self._wsunblocked.wait()
+
+        # Once per batch is plenty, they expire after seconds
+        self._triage_sent_by_self()
+
+        # Do not even call the logging functions when they would log nothing
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        status = self._status
+        sent_by_self = self._sent_by_self
+        handlers = self._event_handlers
+        load_event = self._load_event
+        useless = USELESS_EVENTS
 
         for event in events:
-            t = event.get('type')
-            ts = float(event.get('ts', 0))
+            t = sys.intern(event.get('type', ''))
+            ts_raw = event.get('ts')
 
-            if ts > self._status.last_timestamp:
-                self._status.last_timestamp = ts
+            # Many events (typing, presence, ...) have no timestamp
+            if ts_raw:
+                ts = float(ts_raw)
 
-            if ts in self._sent_by_self:
-                self._sent_by_self.remove(ts)
-                continue
+                if ts > status.last_timestamp:
+                    status.last_timestamp = ts
+
+                channel = event.get('channel')
+                if type(channel) is str and (key := (channel, ts_raw)) in sent_by_self:
+                    sent_by_self.discard(key)
+                    continue
 
-            if t in USELESS_EVENTS:
+            if t in useless:
                 continue
 
-            logging.debug(event)
+            # The same few ids are repeated in all the events, keep one copy of each
+            for k in INTERNED_FIELDS:
+                if type(v := event.get(k)) is str:
+                    event[k] = sys.intern(v)
+
+            if debug:
+                logging.debug(event)
             try:
-                ev: Optional[SlackEvent] = self.tload(
-                    event,
-                    SlackEvent  # type: ignore
-                )
-            except TypedloadValueError:
+                ev: Optional[SlackEvent] = load_event(event, t)
+            except TypedloadException:
                 continue
 
-            logging.debug(ev)
+            if debug:
+                logging.debug(ev)
 
-            self._triage_sent_by_self()
+            # Keep the caches updated
+            handler = handlers.get(type(ev))
+            if handler is not None:
+                handler(ev)
 
-            if isinstance(ev, (Join, Leave)) and ev.channel in self._get_members_cache:
-                if isinstance(ev, Join):
-                    self._get_members_cache[ev.channel].add(ev.user)
-                else:
-                    self._get_members_cache[ev.channel].discard(ev.user)
+            yield ev
 
-            if isinstance(ev, UserChange):
-                if ev.user.id in self._usercache:
-                    del self._usercache[ev.user.id]
-                    # FIXME don't know if it is wise, maybe it gets lost forever del self._usermapcache[u.name]
-                    # TODO make an event for this
-                else:
-                    logging.info(event)
+    def _load_event(self, event: dict[str, Any], t: str) -> SlackEvent:
+        """
+        Load a websocket event.
 
-            yield ev
+        The class is picked from the (type, subtype) of the event, so
+        typedload does not have to try the whole union. If the event
+        does not fit that class, the whole union is tried anyway.
+        """
+        subtype = event.get('subtype')
+        if subtype == 'bot_message' and 'user' in event:
+            # Message comes before MessageBot in the union, so these
+            # were always loaded as normal messages from that user
+            type_: Any = Message
+        else:
+            type_ = EVENT_DISPATCH.get((t, subtype))
+        if type_ is not None:
+            try:
+                return self.loader.load(event, type_)
+            except TypedloadException:
+                pass
+        return self.tload(event, SlackEvent)  # type: ignore
+
+    def _on_join(self, ev: Join) -> None:
+        members = self._get_members_cache.get(ev.channel)
+        if members is not None:
+            members.add(ev.user)
+
+    def _on_leave(self, ev: Leave) -> None:
+        members = self._get_members_cache.get(ev.channel)
+        if members is not None:
+            members.discard(ev.user)
+
+    def _on_user_change(self, ev: UserChange) -> None:
+        if ev.user.id in self._usercache:
+            # The event contains the whole updated user
+            self._insert_user(ev.user)
+            # TODO make an event for this
+        else:
+            logging.info(ev)
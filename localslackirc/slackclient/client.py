@@ -22,7 +22,6 @@
 # to the changes made since it was copied.
 
 import asyncio
-import json
 from typing import Any, Dict, List, NamedTuple, Optional
 
 from typedload import load
@@ -30,7 +29,11 @@ import websockets
 from websockets.client import connect as wsconnect
 
 from .exceptions import SlackConnectionError, SlackLoginError
-from .http import Request
+from .http import Request, json_dumps, json_loads
+
+
+#: How many API calls can be in progress at the same time
+MAX_API_CALLS = 8
 
 
 class Team(NamedTuple):
@@ -63,6 +66,7 @@ class SlackClient:
         # RTM configs
         self._websocket: Optional[websockets.client.WebSocketClientProtocol] = None
         self._request = Request('https://slack.com/api/')
+        self._api_calls = asyncio.Semaphore(MAX_API_CALLS)
         self._wsid = 0
 
     async def wspacket(self, **kwargs) -> None:
@@ -73,7 +77,7 @@ class SlackClient:
             raise Exception('No websocket at this point')
         kwargs['id'] = self._wsid
         self._wsid += 1
-        await self._websocket.send(json.dumps(kwargs))
+        await self._websocket.send(json_dumps(kwargs))
 
     def __del__(self):
         self.close()
@@ -106,7 +110,15 @@ class SlackClient:
         if self._cookie:
             headers['cookie'] = self._cookie
 
-        return await self._request.post(request, headers, post_data, timeout)
+        # Limit the concurrent requests, to not trip slack's rate limits
+        async with self._api_calls:
+            return await self._request.post(request, headers, post_data, timeout)
+
+    def close_connection(self) -> None:
+        """
+        Close the HTTP connection used by the current task.
+        """
+        self._request.close_connection()
 
     async def login(self, timeout: float = 0.0) -> LoginInfo:
         """
@@ -171,5 +183,5 @@ class SlackClient:
         data = []
         if json_data != '':
             for d in json_data.split('\n'):
-                data.append(json.loads(d))
+                data.append(json_loads(d))
         return data
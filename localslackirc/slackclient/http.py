@@ -23,6 +23,31 @@ from typing import Dict, NamedTuple, Tuple, Any
 from uuid import uuid1
 from urllib import parse
 
+try:
+    from orjson import dumps as _orjson_dumps, loads as json_loads  # type: ignore
+
+    def json_dumps(obj: Any) -> str:
+        return _orjson_dumps(obj).decode('utf8')
+except ModuleNotFoundError:
+    from json import loads as json_loads  # type: ignore
+
+    def json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=True)
+
+
+class UploadFile(NamedTuple):
+    """
+    The content of a file to upload.
+
+    It can be used in place of an open file, but it can
+    be read several times, so the request can be retried.
+    """
+    name: str
+    data: bytes
+
+    def read(self) -> bytes:
+        return self.data
+
 
 def multipart_form(form_fields: Dict[str, Any]) -> Tuple[str, bytes]:
     """
@@ -48,21 +73,22 @@ def multipart_form(form_fields: Dict[str, Any]) -> Tuple[str, bytes]:
 
     boundary = str(uuid1()).encode('ascii')
 
-    form_data = b''
+    # Collect the parts and join them once, so the file content is not copied over and over
+    form_data = []
     for k, v in data.items():
-        form_data += b'--' + boundary + b'\r\n'
+        form_data.append(b'--' + boundary + b'\r\n')
         if hasattr(v, 'read') and hasattr(v, 'name'):
-            form_data += f'Content-Disposition: form-data; name="{k}"; filename="{v.name}"\r\n'.encode('ascii')
-            form_data += b'\r\n' + v.read() + b'\r\n'
+            form_data.append(f'Content-Disposition: form-data; name="{k}"; filename="{v.name}"\r\n'.encode('ascii'))
+            form_data += (b'\r\n', v.read(), b'\r\n')
         else:
             strv = str(v)
-            form_data += f'Content-Disposition: form-data; name="{k}"\r\n'.encode('ascii')
-            form_data += b'\r\n' + strv.encode('ascii') + b'\r\n'
+            form_data.append(f'Content-Disposition: form-data; name="{k}"\r\n'.encode('ascii'))
+            form_data += (b'\r\n', strv.encode('ascii'), b'\r\n')
 
-    form_data += b'--' + boundary + b'\r\n'
+    form_data.append(b'--' + boundary + b'\r\n')
 
     header = f'Content-Type: multipart/form-data; boundary={boundary.decode("ascii")}\r\n'
-    return header, form_data
+    return header, b''.join(form_data)
 
 
 class Response(NamedTuple):
@@ -71,7 +97,7 @@ class Response(NamedTuple):
     data: bytes
 
     def json(self):
-        return json.loads(self.data)
+        return json_loads(self.data)
 
 
 class Request:
@@ -115,6 +141,19 @@ class Request:
             self._connections[key] = r
         return r
 
+    def close_connection(self) -> None:
+        """
+        Close the connection cached for the current task, if any.
+
+        Connections are cached per task, so a task that is about
+        to end should call this, or its connection is left open.
+        """
+        task = asyncio.tasks.current_task()
+        assert task is not None  # Mypy doesn't notice this is in an async
+        r = self._connections.pop(task.get_name(), None)
+        if r is not None:
+            r[1].close()
+
     async def post(self, path: str, headers: Dict[str, str], data: Dict[str, Any], timeout: float = 0) -> Response:
         """
         post a request.
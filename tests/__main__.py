@@ -18,11 +18,13 @@
 
 import unittest
 
+from .test_bounded_set import *  # NOQA
 from .test_diff import *  # NOQA
 from .test_executable import *  # NOQA
 from .test_message_bot import *  # NOQA
 from .test_irc import *  # NOQA
 from .test_msgparsing import *  # NOQA
+from .test_slack import *  # NOQA
 
 if __name__ == '__main__':
     unittest.main()
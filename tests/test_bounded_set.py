@@ -0,0 +1,53 @@
+# localslackirc
+# Copyright (C) 2022 Salvo "LtWorf" Tomaselli
+#
+# localslackirc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest import mock
+
+from localslackirc.slack import BoundedSet
+
+
+class TestBoundedSet(unittest.TestCase):
+    def test_maxlen(self):
+        s = BoundedSet(3)
+        for i in range(5):
+            s.add(i)
+        assert len(s) == 3
+        assert 1 not in s
+        assert 2 in s
+        assert 4 in s
+
+    def test_discard(self):
+        s = BoundedSet(3)
+        s.add(1)
+        s.discard(1)
+        s.discard(2)
+        assert 1 not in s
+        assert len(s) == 0
+
+    def test_expire(self):
+        s = BoundedSet(10)
+        with mock.patch('localslackirc.slack.monotonic') as monotonic:
+            for i in range(5):
+                monotonic.return_value = i
+                s.add(i)
+            s.discard(3)
+            monotonic.return_value = 13
+            s.expire(10)
+            assert len(s) == 1
+            assert 4 in s
+            s.expire(0)
+            assert len(s) == 0
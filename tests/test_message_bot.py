@@ -77,3 +77,17 @@ class TestMessageBot(unittest.TestCase):
             "| print('Hello world')",
             "| ```"
         ])
+
+    def test_crlf_attachment_text(self):
+        event = template.copy()
+        event.update({
+            "attachments": [
+                {"text": "first line\r\nsecond line"},
+            ]
+        })
+        msg = load(event, MessageBot)
+        self.assertEqual(msg.text.split("\n"), [
+            "This is a message with attachments",
+            "| first line",
+            "| second line",
+        ])
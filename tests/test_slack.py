@@ -0,0 +1,252 @@
+# localslackirc
+# Copyright (C) 2022 Salvo "LtWorf" Tomaselli
+#
+# localslackirc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import IsolatedAsyncioTestCase, mock
+
+import localslackirc.slack
+
+from localslackirc.slack import HistoryBotMessage, HistoryMessage, Join, Message, MessageBot, Profile, Slack, User
+
+
+class TestSlack(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.slack = Slack('token', None, None)
+        self.slack.client = mock.AsyncMock()
+        self.slack.client.close_connection = mock.Mock()
+
+
+class TestEvents(TestSlack):
+    async def events(self, *events):
+        self.slack.client.rtm_read.return_value = list(events)
+        return [i async for i in self.slack.events()]
+
+    async def test_dispatch(self):
+        events = await self.events(
+            {'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'hi', 'ts': '1.1'},
+            {'type': 'message', 'subtype': 'bot_message', 'channel': 'C1', 'bot_id': 'B1', 'text': 'hi', 'ts': '1.2'},
+            {'type': 'member_joined_channel', 'channel': 'C1', 'user': 'U1'},
+        )
+        assert [type(i) for i in events] == [Message, MessageBot, Join]
+
+    async def test_message_subtypes(self):
+        events = await self.events(
+            {'type': 'message', 'subtype': 'me_message', 'channel': 'C1', 'user': 'U1', 'text': 'waves', 'ts': '1.1'},
+            {'type': 'message', 'subtype': 'file_share', 'channel': 'C1', 'user': 'U1', 'text': '', 'ts': '1.2'},
+            {'type': 'message', 'subtype': 'thread_broadcast', 'channel': 'C1', 'user': 'U1', 'text': 'hi', 'ts': '1.3', 'thread_ts': '1.0'},
+        )
+        assert [type(i) for i in events] == [Message, Message, Message]
+        assert events[0].is_action
+        assert events[2].thread_ts == '1.0'
+
+    async def test_bot_message_without_bot_id(self):
+        events = await self.events(
+            {'type': 'message', 'subtype': 'bot_message', 'channel': 'C1', 'user': 'U1', 'text': 'hi', 'ts': '1.2'},
+        )
+        assert [type(i) for i in events] == [Message]
+
+    async def test_bot_message_with_user(self):
+        events = await self.events(
+            {'type': 'message', 'subtype': 'bot_message', 'channel': 'C1', 'user': 'U1', 'bot_id': 'B1', 'text': 'hi', 'ts': '1.2'},
+        )
+        assert [type(i) for i in events] == [Message]
+        assert events[0].user == 'U1'
+
+    async def test_malformed(self):
+        with self.assertLogs(level='ERROR'):
+            events = await self.events(
+                {'type': 'message', 'subtype': 'bot_message', 'channel': 'C1', 'text': 'hi', 'ts': '1.2', 'username': 'x'},
+                {'type': 'message', 'subtype': 'message_changed', 'channel': 'C1', 'ts': '1.3'},
+                {'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'after', 'ts': '1.4'},
+            )
+        assert len(events) == 1
+        assert events[0].text == 'after'
+
+
+class TestLoadHistory(TestSlack):
+    def load(self, *messages):
+        return self.slack._load_history({'ok': True, 'has_more': False, 'messages': list(messages)}).messages
+
+    def test_messages(self):
+        messages = self.load(
+            {'type': 'message', 'user': 'U1', 'text': 'hi', 'ts': '1.1'},
+            {'type': 'message', 'subtype': 'bot_message', 'bot_id': 'B1', 'text': 'hi', 'ts': '1.2'},
+        )
+        assert [type(i) for i in messages] == [HistoryMessage, HistoryBotMessage]
+        assert messages[0].ts == 1.1
+        assert messages[1].bot_id == 'B1'
+
+    def test_bot_message_without_bot_id(self):
+        messages = self.load(
+            {'type': 'message', 'subtype': 'bot_message', 'user': 'U1', 'text': 'hi', 'ts': '1.2'},
+        )
+        assert [type(i) for i in messages] == [HistoryMessage]
+        assert messages[0].user == 'U1'
+
+
+class TestUserCache(TestSlack):
+    async def counters(self):
+        return (
+            await self.slack.count_regular_users(),
+            await self.slack.count_bots(),
+            await self.slack.count_admins(),
+        )
+
+    async def test_insert(self):
+        self.slack._insert_user(User('U1', 'alice', Profile(), 0))
+        self.slack._insert_user(User('U2', 'bot', Profile(), 0, is_bot=True))
+        self.slack._insert_user(User('U3', 'boss', Profile(), 0, is_admin=True))
+        assert await self.counters() == (2, 1, 1)
+        assert self.slack._usermapcache['bot'].id == 'U2'
+
+    async def test_replace(self):
+        self.slack._insert_user(User('U1', 'alice', Profile(), 0))
+        self.slack._insert_user(User('U1', 'alice', Profile(), 1, is_admin=True))
+        assert await self.counters() == (1, 0, 1)
+        self.slack._insert_user(User('U1', 'alice', Profile(), 2, is_bot=True))
+        assert await self.counters() == (0, 1, 0)
+        assert len(self.slack._usercache) == 1
+
+    async def test_rename(self):
+        self.slack._insert_user(User('U1', 'alice', Profile(), 0))
+        self.slack._insert_user(User('U1', 'alicia', Profile(), 1))
+        assert await self.counters() == (1, 0, 0)
+        assert 'alice' not in self.slack._usermapcache
+        assert self.slack._usermapcache['alicia'].id == 'U1'
+
+    async def test_rename_taken_name(self):
+        # The old name was given to someone else in the meantime
+        self.slack._insert_user(User('U1', 'alice', Profile(), 0))
+        self.slack._insert_user(User('U2', 'alice', Profile(), 0))
+        self.slack._insert_user(User('U1', 'alicia', Profile(), 1))
+        assert self.slack._usermapcache['alice'].id == 'U2'
+        assert await self.counters() == (2, 0, 0)
+
+    async def test_get_user_by_name_refetch(self):
+        self.slack.client.api_call.return_value = {
+            'ok': True,
+            'members': [{'id': 'U1', 'name': 'alice', 'profile': {}, 'updated': 0}],
+        }
+        with mock.patch.object(localslackirc.slack, 'monotonic') as monotonic:
+            monotonic.return_value = 1000
+            assert (await self.slack.get_user_by_name('alice')).id == 'U1'
+            assert self.slack.client.api_call.await_count == 1
+
+            # Unknown names do not download the list again within a minute
+            monotonic.return_value = 1030
+            with self.assertRaises(KeyError):
+                await self.slack.get_user_by_name('bob')
+            assert self.slack.client.api_call.await_count == 1
+
+            monotonic.return_value = 1061
+            with self.assertRaises(KeyError):
+                await self.slack.get_user_by_name('bob')
+            assert self.slack.client.api_call.await_count == 2
+
+
+class TestIMCache(TestSlack):
+    def test_get_put(self):
+        self.slack._imcache_put('U1', 'D1')
+        assert self.slack._imcache_get('U1') == 'D1'
+        assert self.slack._imcache_get('U2') is None
+        assert self.slack._imcache_reverse == {'D1': 'U1'}
+
+    def test_eviction(self):
+        with mock.patch.object(localslackirc.slack, 'IMCACHE_SIZE', 2):
+            self.slack._imcache_put('U1', 'D1')
+            self.slack._imcache_put('U2', 'D2')
+            # Using U1 makes U2 the oldest
+            self.slack._imcache_get('U1')
+            self.slack._imcache_put('U3', 'D3')
+        assert dict(self.slack._imcache) == {'U1': 'D1', 'U3': 'D3'}
+        assert self.slack._imcache_reverse == {'D1': 'U1', 'D3': 'U3'}
+
+    async def test_changed_im(self):
+        with mock.patch.object(localslackirc.slack, 'IMCACHE_SIZE', 2):
+            self.slack._imcache_put('U1', 'D1')
+            self.slack._imcache_put('U1', 'D9')
+            assert self.slack._imcache_reverse == {'D9': 'U1'}
+            self.slack._imcache_put('U2', 'D2')
+            self.slack._imcache_put('U3', 'D3')
+        # U1 is evicted and its old IM is unknown
+        assert self.slack._imcache_reverse == {'D2': 'U2', 'D3': 'U3'}
+        self.slack.client.api_call.return_value = {'ok': True, 'channels': []}
+        assert await self.slack.get_im('D1') is None
+
+
+class TestPaginate(TestSlack):
+    async def pages(self, *replies):
+        self.slack.client.api_call.side_effect = list(replies)
+        r = [i async for i in self.slack._paginate('some.api', limit=10)]
+        cursors = [i.kwargs['cursor'] for i in self.slack.client.api_call.call_args_list]
+        return r, cursors
+
+    async def test_follow_cursor(self):
+        pages, cursors = await self.pages(
+            {'n': 1, 'response_metadata': {'next_cursor': 'a'}},
+            {'n': 2, 'has_more': True, 'response_metadata': {'next_cursor': 'b'}},
+            {'n': 3},
+        )
+        assert [i['n'] for i in pages] == [1, 2, 3]
+        assert cursors == [None, 'a', 'b']
+
+    async def test_has_more_false(self):
+        pages, cursors = await self.pages(
+            {'n': 1, 'has_more': False, 'response_metadata': {'next_cursor': 'a'}},
+        )
+        assert len(pages) == 1
+        assert cursors == [None]
+
+    async def test_empty_cursor(self):
+        pages, cursors = await self.pages(
+            {'n': 1, 'response_metadata': {'next_cursor': 'a'}},
+            {'n': 2, 'response_metadata': {'next_cursor': ''}},
+        )
+        assert len(pages) == 2
+        assert cursors == [None, 'a']
+
+    async def test_repeated_cursor(self):
+        pages, cursors = await self.pages(
+            {'n': 1, 'response_metadata': {'next_cursor': 'a'}},
+            {'n': 2, 'response_metadata': {'next_cursor': 'a'}},
+        )
+        assert len(pages) == 2
+        assert cursors == [None, 'a']
+
+
+class TestInternalEvents(TestSlack):
+    async def test_queued_during_read(self):
+        # The IRC side queues a Join while the websocket is being read
+        join = Join('member_joined_channel', 'U2', 'C1')
+
+        async def rtm_read():
+            self.slack._internalevents.append(join)
+            return [{'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'hi', 'ts': '1.1'}]
+        self.slack.client.rtm_read = rtm_read
+
+        events = [i async for i in self.slack.events()]
+        assert events[0] is join
+        assert [type(i) for i in events] == [Join, Message]
+        assert events[1].text == 'hi'
+
+    async def test_history_after_reconnect(self):
+        self.slack.client.rtm_read.side_effect = ConnectionResetError()
+
+        async def history():
+            self.slack._internalevents.append('history')
+        with mock.patch.object(self.slack, '_history', history):
+            events = [i async for i in self.slack.events()]
+        assert events == ['history']
+        self.slack.client.rtm_connect.assert_awaited_once()